@@ -0,0 +1,134 @@
+"""
+Chat message model, JSON encoding and outgoing frame batching
+Kept free of import-time side effects so it can be tested without the app
+"""
+
+import re
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Optional
+from collections import defaultdict
+
+import orjson
+
+logger = logging.getLogger('tc')
+
+@dataclass(slots=True)
+class Msg:
+    """A chat message as stored in history and sent to clients"""
+    id: str
+    user: str
+    message: str
+    timestamp: int
+    type: str
+    confidence: Optional[float] = None
+    actions: Optional[list] = None
+    error: Optional[bool] = None
+    
+    def to_dict(self):
+        """Wire/orchestrator representation, omitting unset fields"""
+        return {f: v for f in self.__slots__ if (v := getattr(self, f)) is not None}
+
+def _json_default(obj):
+    if isinstance(obj, Msg):
+        return obj.to_dict()
+    raise TypeError
+
+def encode_json(obj):
+    """orjson encode with Msg support"""
+    return orjson.dumps(obj, default=_json_default, option=orjson.OPT_PASSTHROUGH_DATACLASS)
+
+class OrjsonCodec:
+    """orjson behind the json module interface Socket.IO expects"""
+    
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return encode_json(obj).decode()
+    
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+# Outgoing events are coalesced per room and flushed as one 'batch' frame
+BATCH_INTERVAL = 0.008  # seconds
+BATCH_MAX_MESSAGES = 128
+BATCH_MAX_BYTES = 64 * 1024
+
+# Characters JSON escapes; each grows by at most 5 bytes (\u00XX)
+_JSON_ESCAPED = re.compile(r'["\\\x00-\x1f]')
+
+def estimate_size(data):
+    """Upper bound on the encoded size of a payload, without encoding it"""
+    if isinstance(data, str):
+        return len(data.encode()) + 2 + 5 * len(_JSON_ESCAPED.findall(data))
+    if isinstance(data, Msg):
+        return 2 + sum(
+            estimate_size(f) + 2 + estimate_size(v)
+            for f in data.__slots__ if (v := getattr(data, f)) is not None
+        )
+    if isinstance(data, dict):
+        return 2 + sum(estimate_size(str(k)) + 2 + estimate_size(v) for k, v in data.items())
+    if isinstance(data, (list, tuple)):
+        return 2 + sum(estimate_size(v) + 1 for v in data)
+    if data is None or isinstance(data, (bool, int, float)):
+        return 24  # Longest float repr
+    return len(encode_json(data))
+
+class RoomBatcher:
+    """Buffer emits per room and flush them as a single Socket.IO frame"""
+    
+    def __init__(self, sio):
+        self.socketio = sio
+        self.buffers = defaultdict(list)
+        self.lock = threading.Lock()
+        self.flusher = None
+    
+    def queue(self, room, event, data, skip_sid=None):
+        """Queue an event for the room, sent on the next flush"""
+        item = {'event': event, 'data': data}
+        size = estimate_size(item)
+        with self.lock:
+            self.buffers[room, skip_sid].append((item, size))
+            if self.flusher is None:
+                self.flusher = self.socketio.start_background_task(self._run)
+    
+    def _run(self):
+        while True:
+            self.socketio.sleep(BATCH_INTERVAL)
+            # Never let an error kill the flusher; queue() would not restart it
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("batch_flush_error")
+            
+            # Stop when idle; the next queue() starts a new flusher
+            with self.lock:
+                if not self.buffers:
+                    self.flusher = None
+                    return
+    
+    def flush(self):
+        """Emit everything buffered so far, one frame per room"""
+        with self.lock:
+            buffers, self.buffers = self.buffers, defaultdict(list)
+        
+        for (room, skip_sid), items in buffers.items():
+            try:
+                for batch in self._split(items):
+                    self.socketio.emit('batch', batch, room=room, skip_sid=skip_sid)
+            except Exception:
+                logger.exception("batch_emit_error room=%s", room)
+    
+    @staticmethod
+    def _split(items):
+        """Split buffered items into frames capped by count and encoded size"""
+        batch, batch_size = [], 2  # Enclosing brackets
+        for item, size in items:
+            if batch and (len(batch) >= BATCH_MAX_MESSAGES or batch_size + size + 1 > BATCH_MAX_BYTES):
+                yield batch
+                batch, batch_size = [], 2
+            batch.append(item)
+            batch_size += size + 1  # Separating comma
+        if batch:
+            yield batch
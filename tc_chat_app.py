@@ -4,43 +4,195 @@ Transaction Coordinator Chat App - Ready for Render
 Complete 2-way chat interface with WebSocket support
 """
 
-from flask import Flask, render_template, request, jsonify
+# Patch blocking I/O before anything else is imported so orchestrator/Grok
+# HTTP calls and Redis round-trips yield to other greenlets
+import eventlet
+eventlet.monkey_patch()
+import eventlet.wsgi
+
+from flask import Flask, Response, render_template, request
 from flask_socketio import SocketIO, emit, join_room, leave_room
 import os
-import json
+import sys
+import socket
+import atexit
 import time
+import queue
+import logging
+import logging.handlers
+import threading
+import hashlib
 from datetime import datetime
 import uuid
-from collections import defaultdict
+from collections import deque
+from itertools import islice
+import redis
+import orjson
+import brotli
+from cachetools import TTLCache
+
+from chat_protocol import Msg, OrjsonCodec, RoomBatcher, encode_json
 
 # Import existing TC modules
 from modules.ai.grok_client import GrokClient
 from modules.agents.orchestrator import AgentOrchestrator
 
+REDIS_URL = os.getenv('REDIS_URL')
+
+# Log records are queued and written by a listener so handlers never block
+# on stdout
+_log_queue = queue.Queue(-1)
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush queued records on shutdown
+
+logger = logging.getLogger('tc')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'tc-chat-secret-2024')
-socketio = SocketIO(app, cors_allowed_origins="*")
+# Static URLs carry a content hash, so they can be cached for a year
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000
+
+# Emits go through Redis pub/sub when REDIS_URL is set so background tasks
+# reach clients connected to any worker
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    json=OrjsonCodec,
+    message_queue=REDIS_URL,
+    async_mode='eventlet'
+)
+
+# Chat history lives in Redis when REDIS_URL is set so it survives restarts
+# and is shared by every worker; otherwise fall back to in-memory storage
+SESSION_MAX_MESSAGES = 200
+SESSION_TTL = 86400  # seconds
+SESSION_INDEX_KEY = 'tc:sessions'
+
+# In-memory fallback limits: idle sessions are evicted after SESSION_IDLE_TTL
+SESSION_CACHE_SIZE = 10000
+SESSION_IDLE_TTL = 3600  # seconds
+SESSION_SWEEP_INTERVAL = 900  # seconds
 
-# In-memory storage (replace with Redis on Render for persistence)
-chat_sessions = defaultdict(list)
+redis_client = redis.Redis.from_url(
+    REDIS_URL, decode_responses=True, max_connections=50
+) if REDIS_URL else None
+
+chat_sessions = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_IDLE_TTL)
+sessions_lock = threading.RLock()
 active_users = {}
 
+_uuid = uuid.uuid4
+
+_WELCOME_FMT = "👋 Hi %s! I'm Nicki, your Transaction Coordinator. How can I help you today?"
+
+def _now_ms():
+    """Message timestamp as epoch milliseconds (formatted client-side)"""
+    return int(time.time() * 1000)
+
+def _orchestrator_history(messages):
+    """History dicts in the orchestrator's format, with ISO timestamps"""
+    history = []
+    for m in messages:
+        entry = m.to_dict()
+        entry['timestamp'] = datetime.fromtimestamp(m.timestamp / 1000).isoformat()
+        history.append(entry)
+    return history
+
+def _session_key(session_id):
+    return f"tc:sess:{session_id}"
+
+def append_message(session_id, msg):
+    """Append a message to the session history"""
+    if redis_client is None:
+        with sessions_lock:
+            history = chat_sessions.get(session_id)
+            if history is None:
+                history = deque(maxlen=SESSION_MAX_MESSAGES)
+            history.append(msg)
+            # Re-inserting refreshes the idle TTL
+            chat_sessions[session_id] = history
+        return
+    
+    # Single round-trip: append, trim, refresh TTL and index the session
+    key = _session_key(session_id)
+    now = time.time()
+    pipe = redis_client.pipeline()
+    pipe.rpush(key, encode_json(msg))
+    pipe.ltrim(key, -SESSION_MAX_MESSAGES, -1)
+    pipe.expire(key, SESSION_TTL)
+    pipe.zadd(SESSION_INDEX_KEY, {session_id: now})
+    pipe.zremrangebyscore(SESSION_INDEX_KEY, '-inf', now - SESSION_TTL)
+    pipe.execute()
+
+def get_history(session_id, limit):
+    """Return the last `limit` messages of the session history"""
+    if redis_client is None:
+        with sessions_lock:
+            history = chat_sessions.get(session_id, ())
+            return list(islice(history, max(0, len(history) - limit), None))
+    
+    return [Msg(**orjson.loads(m)) for m in redis_client.lrange(_session_key(session_id), -limit, -1)]
+
+def count_sessions():
+    """Number of sessions with activity within the session TTL"""
+    if redis_client is None:
+        with sessions_lock:
+            return len(chat_sessions)
+    
+    return redis_client.zcount(SESSION_INDEX_KEY, time.time() - SESSION_TTL, '+inf')
+
+def sweep_sessions():
+    """Periodically drop idle in-memory sessions"""
+    while True:
+        socketio.sleep(SESSION_SWEEP_INTERVAL)
+        with sessions_lock:
+            chat_sessions.expire()
+
+if redis_client is None:
+    socketio.start_background_task(sweep_sessions)
+
+# A client message id seen again within this window is a retry
+DUPLICATE_WINDOW = 30  # seconds
+
 class TCChatHandler:
     def __init__(self):
         self.grok_client = GrokClient()
         self.orchestrator = AgentOrchestrator()
+        self.recent_messages = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=DUPLICATE_WINDOW)
+        self.recent_lock = threading.Lock()
+    
+    def is_duplicate(self, session_id, msg_id):
+        """Check (and record) whether this message id was just sent to the session"""
+        if redis_client is not None:
+            # Shared across workers, so retries after a reconnect are caught too
+            key = f"tc:dup:{session_id}:{msg_id}"
+            return not redis_client.set(key, 1, nx=True, ex=DUPLICATE_WINDOW)
+        
+        key = (session_id, msg_id)
+        with self.recent_lock:
+            if key in self.recent_messages:
+                return True
+            self.recent_messages[key] = True
+            return False
         
-    def process_message(self, message, session_id, user_name):
+    def process_message(self, message, session_id, user_name, reply_id=None, msg_id=None):
         """Process incoming chat message"""
+        reply_id = reply_id or _uuid().hex
         try:
-            # Add to conversation history
-            chat_sessions[session_id].append({
-                'id': str(uuid.uuid4()),
-                'user': user_name,
-                'message': message,
-                'timestamp': datetime.now().isoformat(),
-                'type': 'user'
-            })
+            # Add to conversation history, under the id the room already saw
+            append_message(session_id, Msg(
+                id=msg_id or _uuid().hex,
+                user=user_name,
+                message=message,
+                timestamp=_now_ms(),
+                type='user'
+            ))
             
             # Process through TC system
             response = self.orchestrator.process_message({
@@ -48,70 +200,80 @@ class TCChatHandler:
                 'text': message,
                 'source': 'web_chat',
                 'session_id': session_id,
-                'history': chat_sessions[session_id][-10:]  # Last 10 messages
+                'history': _orchestrator_history(get_history(session_id, 10))  # Last 10 messages
             })
             
             # Format response
-            tc_response = {
-                'id': str(uuid.uuid4()),
-                'user': 'Nicki (TC)',
-                'message': response.get('response', 'I need to think about that...'),
-                'timestamp': datetime.now().isoformat(),
-                'type': 'assistant',
-                'confidence': response.get('confidence', 0.8),
-                'actions': response.get('actions', [])
-            }
+            tc_response = Msg(
+                id=reply_id,
+                user='Nicki (TC)',
+                message=response.get('response', 'I need to think about that...'),
+                timestamp=_now_ms(),
+                type='assistant',
+                confidence=response.get('confidence', 0.8),
+                actions=response.get('actions', [])
+            )
             
-            chat_sessions[session_id].append(tc_response)
+            append_message(session_id, tc_response)
             
             return tc_response
             
-        except Exception as e:
-            print(f"Error processing message: {e}")
-            return {
-                'id': str(uuid.uuid4()),
-                'user': 'Nicki (TC)',
-                'message': 'I encountered an error. Please try again.',
-                'timestamp': datetime.now().isoformat(),
-                'type': 'assistant',
-                'error': True
-            }
+        except Exception:
+            logger.exception("process_error session=%s", session_id)
+            return Msg(
+                id=reply_id,
+                user='Nicki (TC)',
+                message='I encountered an error. Please try again.',
+                timestamp=_now_ms(),
+                type='assistant',
+                error=True
+            )
 
 # Initialize handler
 tc_handler = TCChatHandler()
+batcher = RoomBatcher(socketio)
 
 @app.route('/')
 def index():
     """Serve the chat interface"""
-    return render_template('chat.html')
+    if request.accept_encodings['br']:
+        response = Response(_CACHED_INDEX_BR, mimetype='text/html')
+        response.content_encoding = 'br'
+        response.set_etag(_INDEX_ETAG + '-br')
+    else:
+        response = Response(_CACHED_INDEX, mimetype='text/html')
+        response.set_etag(_INDEX_ETAG)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
+
+# Probed every few seconds per instance, so skip the JSON encoder entirely
+_HEALTH_TMPL = b'{"status":"healthy","timestamp":%d,"active_sessions":%d,"active_users":%d}'
 
 @app.route('/api/health')
 def health():
     """Health check for Render"""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
-        'active_sessions': len(chat_sessions),
-        'active_users': len(active_users)
-    })
+    body = _HEALTH_TMPL % (_now_ms(), count_sessions(), len(active_users))
+    return Response(body, mimetype='application/json')
 
 @socketio.on('connect')
 def handle_connect():
     """Handle new connection"""
-    print(f"Client connected: {request.sid}")
+    logger.info("connect sid=%s", request.sid)
     emit('connected', {'status': 'Connected to TC Chat'})
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle disconnection"""
-    print(f"Client disconnected: {request.sid}")
+    logger.info("disconnect sid=%s", request.sid)
     if request.sid in active_users:
         del active_users[request.sid]
 
 @socketio.on('join_chat')
 def handle_join(data):
     """Handle user joining chat"""
-    session_id = data.get('session_id', str(uuid.uuid4()))
+    session_id = data.get('session_id') or _uuid().hex
     user_name = data.get('user_name', 'Guest')
     
     join_room(session_id)
@@ -121,21 +283,21 @@ def handle_join(data):
     }
     
     # Send chat history
-    history = chat_sessions.get(session_id, [])
+    history = get_history(session_id, 50)
     
     # Send welcome message if new session
     if not history:
-        welcome = {
-            'id': str(uuid.uuid4()),
-            'user': 'Nicki (TC)',
-            'message': f"👋 Hi {user_name}! I'm Nicki, your Transaction Coordinator. How can I help you today?",
-            'timestamp': datetime.now().isoformat(),
-            'type': 'assistant'
-        }
-        chat_sessions[session_id].append(welcome)
+        welcome = Msg(
+            id=_uuid().hex,
+            user='Nicki (TC)',
+            message=_WELCOME_FMT % user_name,
+            timestamp=_now_ms(),
+            type='assistant'
+        )
+        append_message(session_id, welcome)
         history = [welcome]
     
-    emit('chat_history', {'messages': history[-50:]})  # Last 50 messages
+    batcher.queue(request.sid, 'chat_history', {'messages': history})  # Last 50 messages
 
 @socketio.on('send_message')
 def handle_message(data):
@@ -148,290 +310,70 @@ def handle_message(data):
     session_id = user_info.get('session_id', 'default')
     user_name = user_info.get('user_name', 'Guest')
     
-    # Emit user message to room
-    user_msg = {
-        'id': str(uuid.uuid4()),
-        'user': user_name,
-        'message': message,
-        'timestamp': datetime.now().isoformat(),
-        'type': 'user'
-    }
+    # The sender already rendered the message, so reuse its id
+    msg_id = data.get('id')
+    if not isinstance(msg_id, str) or not msg_id or len(msg_id) > 64:
+        msg_id = _uuid().hex
+    elif tc_handler.is_duplicate(session_id, msg_id):
+        # Retried send: the first copy is already stored and being answered
+        return
+    
+    # Emit user message to the rest of the room
+    user_msg = Msg(
+        id=msg_id,
+        user=user_name,
+        message=message,
+        timestamp=_now_ms(),
+        type='user'
+    )
     
-    socketio.emit('new_message', user_msg, room=session_id)
+    batcher.queue(session_id, 'new_message', user_msg, skip_sid=request.sid)
     
-    # Show typing indicator
-    socketio.emit('typing', {'user': 'Nicki (TC)'}, room=session_id)
+    # Open the reply bubble; it doubles as the typing indicator
+    reply_id = _uuid().hex
+    batcher.queue(session_id, 'message_start', {'id': reply_id, 'user': 'Nicki (TC)'})
     
     # Process message in background
     socketio.start_background_task(
         process_and_respond,
         message,
         session_id,
-        user_name
+        user_name,
+        msg_id,
+        reply_id
     )
 
-def process_and_respond(message, session_id, user_name):
+def process_and_respond(message, session_id, user_name, msg_id, reply_id):
     """Process message and send response"""
-    # Simulate thinking time
-    time.sleep(1)
-    
     # Get TC response
-    response = tc_handler.process_message(message, session_id, user_name)
-    
-    # Stop typing indicator
-    socketio.emit('stop_typing', {'user': 'Nicki (TC)'}, room=session_id)
-    
-    # Send response
-    socketio.emit('new_message', response, room=session_id)
-
-# Create templates directory and chat.html
-os.makedirs('templates', exist_ok=True)
-
-chat_html = '''<!DOCTYPE html>
-<html>
-<head>
-    <title>Transaction Coordinator Chat</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <script src="https://cdn.socket.io/4.5.4/socket.io.min.js"></script>
-    <style>
-        * { box-sizing: border-box; margin: 0; padding: 0; }
-        body { 
-            font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
-            background: #f5f5f5;
-            height: 100vh;
-            display: flex;
-            flex-direction: column;
-        }
-        .header {
-            background: #2563eb;
-            color: white;
-            padding: 1rem;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-        }
-        .header h1 {
-            font-size: 1.5rem;
-            display: flex;
-            align-items: center;
-            gap: 0.5rem;
-        }
-        .status {
-            font-size: 0.875rem;
-            opacity: 0.9;
-            margin-top: 0.25rem;
-        }
-        .chat-container {
-            flex: 1;
-            overflow-y: auto;
-            padding: 1rem;
-            display: flex;
-            flex-direction: column;
-            gap: 0.75rem;
-        }
-        .message {
-            max-width: 70%;
-            padding: 0.75rem 1rem;
-            border-radius: 1rem;
-            word-wrap: break-word;
-        }
-        .message.user {
-            align-self: flex-end;
-            background: #2563eb;
-            color: white;
-            border-bottom-right-radius: 0.25rem;
-        }
-        .message.assistant {
-            align-self: flex-start;
-            background: white;
-            border: 1px solid #e5e7eb;
-            border-bottom-left-radius: 0.25rem;
-        }
-        .message-info {
-            font-size: 0.75rem;
-            opacity: 0.7;
-            margin-top: 0.25rem;
-        }
-        .typing {
-            align-self: flex-start;
-            padding: 0.75rem 1rem;
-            background: white;
-            border: 1px solid #e5e7eb;
-            border-radius: 1rem;
-            border-bottom-left-radius: 0.25rem;
-            font-style: italic;
-            opacity: 0.7;
-        }
-        .input-container {
-            background: white;
-            border-top: 1px solid #e5e7eb;
-            padding: 1rem;
-            display: flex;
-            gap: 0.5rem;
-        }
-        #messageInput {
-            flex: 1;
-            padding: 0.75rem;
-            border: 1px solid #e5e7eb;
-            border-radius: 0.5rem;
-            font-size: 1rem;
-            outline: none;
-        }
-        #messageInput:focus {
-            border-color: #2563eb;
-        }
-        #sendButton {
-            padding: 0.75rem 1.5rem;
-            background: #2563eb;
-            color: white;
-            border: none;
-            border-radius: 0.5rem;
-            font-weight: 500;
-            cursor: pointer;
-            transition: background 0.2s;
-        }
-        #sendButton:hover {
-            background: #1d4ed8;
-        }
-        #sendButton:disabled {
-            opacity: 0.5;
-            cursor: not-allowed;
-        }
-        .confidence {
-            display: inline-block;
-            font-size: 0.75rem;
-            padding: 0.125rem 0.5rem;
-            border-radius: 1rem;
-            background: #10b981;
-            color: white;
-            margin-left: 0.5rem;
-        }
-        .confidence.low { background: #ef4444; }
-        .confidence.medium { background: #f59e0b; }
-        
-        @media (max-width: 640px) {
-            .message { max-width: 85%; }
-            .header h1 { font-size: 1.25rem; }
-        }
-    </style>
-</head>
-<body>
-    <div class="header">
-        <h1>🏠 Transaction Coordinator Chat</h1>
-        <div class="status" id="status">Connecting...</div>
-    </div>
-    
-    <div class="chat-container" id="chatContainer"></div>
+    response = tc_handler.process_message(message, session_id, user_name, reply_id, msg_id)
     
-    <div class="input-container">
-        <input type="text" id="messageInput" placeholder="Type your message..." autofocus>
-        <button id="sendButton">Send</button>
-    </div>
-
-    <script>
-        const socket = io();
-        const chatContainer = document.getElementById('chatContainer');
-        const messageInput = document.getElementById('messageInput');
-        const sendButton = document.getElementById('sendButton');
-        const status = document.getElementById('status');
-        
-        // Generate or retrieve session ID
-        let sessionId = localStorage.getItem('tc_session_id');
-        if (!sessionId) {
-            sessionId = 'session_' + Date.now() + '_' + Math.random().toString(36).substr(2, 9);
-            localStorage.setItem('tc_session_id', sessionId);
-        }
-        
-        // Get user name
-        let userName = localStorage.getItem('tc_user_name');
-        if (!userName) {
-            userName = prompt('What\'s your name?') || 'Guest';
-            localStorage.setItem('tc_user_name', userName);
-        }
-        
-        // Socket events
-        socket.on('connect', () => {
-            status.textContent = 'Connected - Chat with Nicki';
-            socket.emit('join_chat', { session_id: sessionId, user_name: userName });
-        });
-        
-        socket.on('disconnect', () => {
-            status.textContent = 'Disconnected - Reconnecting...';
-        });
-        
-        socket.on('chat_history', (data) => {
-            chatContainer.innerHTML = '';
-            data.messages.forEach(msg => addMessage(msg));
-            scrollToBottom();
-        });
-        
-        socket.on('new_message', (message) => {
-            addMessage(message);
-            scrollToBottom();
-        });
-        
-        socket.on('typing', () => {
-            const typingEl = document.createElement('div');
-            typingEl.className = 'typing';
-            typingEl.id = 'typing-indicator';
-            typingEl.textContent = 'Nicki is typing...';
-            chatContainer.appendChild(typingEl);
-            scrollToBottom();
-        });
-        
-        socket.on('stop_typing', () => {
-            const typingEl = document.getElementById('typing-indicator');
-            if (typingEl) typingEl.remove();
-        });
-        
-        // Send message
-        function sendMessage() {
-            const message = messageInput.value.trim();
-            if (!message) return;
-            
-            socket.emit('send_message', { message });
-            messageInput.value = '';
-            messageInput.focus();
-        }
-        
-        sendButton.addEventListener('click', sendMessage);
-        messageInput.addEventListener('keypress', (e) => {
-            if (e.key === 'Enter') sendMessage();
-        });
-        
-        // Add message to chat
-        function addMessage(msg) {
-            const messageEl = document.createElement('div');
-            messageEl.className = `message ${msg.type}`;
-            
-            let content = `<div>${msg.message}</div>`;
-            
-            if (msg.confidence && msg.type === 'assistant') {
-                const level = msg.confidence > 0.8 ? 'high' : msg.confidence > 0.5 ? 'medium' : 'low';
-                content += `<span class="confidence ${level}">${Math.round(msg.confidence * 100)}%</span>`;
-            }
-            
-            content += `<div class="message-info">${msg.user} • ${formatTime(msg.timestamp)}</div>`;
-            
-            messageEl.innerHTML = content;
-            chatContainer.appendChild(messageEl);
-        }
-        
-        function formatTime(timestamp) {
-            const date = new Date(timestamp);
-            return date.toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
-        }
-        
-        function scrollToBottom() {
-            chatContainer.scrollTop = chatContainer.scrollHeight;
-        }
-    </script>
-</body>
-</html>'''
+    # Fill in the reply bubble opened by message_start
+    batcher.queue(session_id, 'message_end', response)
 
-# Write the HTML template
-with open('templates/chat.html', 'w') as f:
-    f.write(chat_html)
+def _render_index():
+    """Render the chat page with a cache-busting stylesheet version"""
+    with open(os.path.join(app.static_folder, 'app.css'), 'rb') as f:
+        css_version = hashlib.sha1(f.read()).hexdigest()[:12]
+    with app.app_context():
+        return render_template('chat.html', css_version=css_version).encode()
+
+# The page has no per-request variables, so render and compress it once
+_CACHED_INDEX = _render_index()
+_CACHED_INDEX_BR = brotli.compress(_CACHED_INDEX, quality=11)
+_INDEX_ETAG = hashlib.sha1(_CACHED_INDEX).hexdigest()
+
+def tune_listener(sock):
+    """Disable Nagle on the listener; accepted sockets inherit it"""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
-    print(f"🚀 TC Chat App starting on port {port}")
-    socketio.run(app, host='0.0.0.0', port=port)
\ No newline at end of file
+    logger.info("TC Chat App starting on port %d", port)
+    
+    # Same server socketio.run() starts for eventlet, with a tuned listener.
+    # Access logging follows app.debug as in socketio.run(); eventlet would
+    # otherwise write a blocking stderr line per request
+    listener = eventlet.listen(('0.0.0.0', port))
+    tune_listener(listener)
+    eventlet.wsgi.server(listener, app, log_output=app.debug)
\ No newline at end of file
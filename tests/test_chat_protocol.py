@@ -0,0 +1,48 @@
+from chat_protocol import (
+    BATCH_MAX_BYTES, BATCH_MAX_MESSAGES, Msg, RoomBatcher, encode_json, estimate_size
+)
+
+def _reply(i, text, actions=None):
+    return Msg(
+        id=f'{i:032x}',
+        user='Nicki (TC)',
+        message=text,
+        timestamp=1700000000000 + i,
+        type='assistant',
+        confidence=0.8,
+        actions=actions
+    )
+
+def _items(payloads):
+    items = []
+    for data in payloads:
+        item = {'event': 'message_end', 'data': data}
+        items.append((item, estimate_size(item)))
+    return items
+
+def test_estimate_is_an_upper_bound():
+    payloads = [
+        'plain ascii',
+        '合同の締切は金曜日です 🏠🔑' * 20,
+        'quotes " and \\ backslashes\n\ttabs \x01 controls',
+        _reply(1, '住所を確認してください 📄', actions=[{'type': 'email', 'body': 'x' * 2000}]),
+        {'messages': [_reply(i, '🙂' * i) for i in range(50)]},
+    ]
+    for data in payloads:
+        assert estimate_size(data) >= len(encode_json(data))
+
+def test_split_frames_stay_under_byte_cap():
+    action = {'type': 'draft', 'body': '見積書を送付しました。' * 70}  # ~2 KB encoded
+    payloads = [_reply(i, '🏠 物件の引き渡し日について ' * 40, actions=[action]) for i in range(40)]
+    
+    frames = list(RoomBatcher._split(_items(payloads)))
+    
+    assert len(frames) > 1
+    assert sum(len(f) for f in frames) == len(payloads)
+    for frame in frames:
+        assert len(frame) == 1 or len(encode_json(frame)) <= BATCH_MAX_BYTES
+
+def test_split_frames_stay_under_message_cap():
+    frames = list(RoomBatcher._split(_items(['ok'] * (BATCH_MAX_MESSAGES * 2 + 1))))
+    
+    assert [len(f) for f in frames] == [BATCH_MAX_MESSAGES, BATCH_MAX_MESSAGES, 1]